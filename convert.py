@@ -20,11 +20,14 @@
 from argparse import (
     ArgumentDefaultsHelpFormatter,
     ArgumentParser,
-    FileType,
     RawDescriptionHelpFormatter,
 )
-from conllu import Token, TokenList
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from conllu import parse
+from conllu.exceptions import ParseException
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Union
 
 import logging
 import lxml.etree
@@ -39,12 +42,212 @@ __version__ = "0.1.0"
 __github__ = "https://github.com/jnphilipp/tei-to-conll-u-converter"
 
 
+NS = "{http://www.tei-c.org/ns/1.0}"
+W_TAG = NS + "w"
+PC_TAG = NS + "pc"
+TOKEN_TAGS = frozenset((W_TAG, PC_TAG))
+# elements that can not contain <w> directly
+DIVISION_TAGS = frozenset(
+    NS + tag
+    for tag in (
+        "TEI",
+        "teiCorpus",
+        "text",
+        "front",
+        "body",
+        "back",
+        "group",
+        "div",
+        "div1",
+        "div2",
+        "div3",
+        "div4",
+        "div5",
+        "div6",
+        "div7",
+    )
+)
+
+
+logger = logging.getLogger(__name__)
+
+
 class ArgFormatter(ArgumentDefaultsHelpFormatter, RawDescriptionHelpFormatter):
     """Combination of ArgumentDefaultsHelpFormatter and RawDescriptionHelpFormatter."""
 
     pass
 
 
+def iter_sentences(source: Union[str, BinaryIO]) -> Iterator[lxml.etree._Element]:
+    """Yield the parents of <w> elements in the order of their first <w>.
+
+    The document is parsed incrementally. Every outermost element below the
+    division level, usually a <p>, is searched as soon as it is complete and
+    freed once its sentences have been consumed, so only one of them is kept in
+    memory. A division element with <w> or <pc> children is kept as a whole.
+    """
+    # number of open elements below the division level
+    depth = 0
+    # for every open division element not below the division level: whether it
+    # has <w> or <pc> children and whether sentences from it were already yielded
+    divisions: List[List[bool]] = []
+    for event, elem in lxml.etree.iterparse(
+        source, events=("start", "end"), collect_ids=False
+    ):
+        if depth == 0 and elem.tag in DIVISION_TAGS:
+            if event == "start":
+                divisions.append([False, False])
+                continue
+            has_tokens, yielded = divisions.pop()
+            if divisions and yielded:
+                divisions[-1][1] = True
+        elif event == "start":
+            if depth == 0 and divisions and elem.tag in TOKEN_TAGS:
+                if divisions[-1][1]:
+                    raise ValueError(
+                        f"Line {elem.sourceline}: {elem.tag} in a division "
+                        "element after converted sentences is not supported."
+                    )
+                divisions[-1][0] = True
+            depth += 1
+            continue
+        else:
+            depth -= 1
+            if depth > 0 or elem.tag in TOKEN_TAGS:
+                continue
+
+        # converted together with the enclosing division
+        if any(has_tokens for has_tokens, _ in divisions):
+            continue
+
+        parents = dict.fromkeys(w.getparent() for w in elem.iter(W_TAG))
+        if parents and divisions:
+            divisions[-1][1] = True
+        yield from parents
+
+        # free the finished block and everything before it
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+def setup_logging(log_format: str, level: int) -> None:
+    """Configure logging to stdout, also used to initialize worker processes."""
+    logging.basicConfig(
+        format=log_format,
+        level=level,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+
+
+def _token_lines(sentence: str) -> List[str]:
+    return [line for line in sentence.split("\n") if line and line[0] != "#"]
+
+
+def is_valid(sentence: str) -> bool:
+    """Check that conllu reads the token lines of a sentence back unchanged."""
+    try:
+        tokenlists = parse(sentence)
+    except ParseException as e:
+        logger.debug("conllu failed to parse the sentence: %s", e)
+        return False
+    if len(tokenlists) != 1:
+        return False
+    # the header is not compared, conllu drops a "# text" line without value
+    return _token_lines(tokenlists[0].serialize()) == _token_lines(sentence)
+
+
+def convert(path: str, validate: bool = False) -> None:
+    """Convert the TEI-XML file at path and save it next to it as CoNLL-U.
+
+    With validate every sentence is checked by parsing it with conllu.
+    """
+    logger.info("Start convertion of %s.", path)
+    out_path = Path(path).with_suffix(".conllu")
+    logger.info("Saving results to %s.", out_path)
+    nb_sentences = 0
+    # write to a temporary file first, an existing output is only replaced
+    # once the whole input has been converted
+    tmp_path = out_path.with_name(f"{out_path.name}.part")
+    try:
+        with open(tmp_path, "w", encoding="utf8", buffering=1 << 23) as f:
+            for p in iter_sentences(path):
+                logger.debug("Parsing words from %s.", p.tag)
+                forms: List[str] = []
+                lemmas: List[Optional[str]] = []
+                upos_tags: List[Optional[str]] = []
+                space_afters: List[bool] = []
+                miscs: List[List[str]] = []
+                text_parts: List[str] = []
+                for e in p.iter(W_TAG, PC_TAG):
+                    attrib = e.attrib
+                    type_ = attrib.get("type")
+                    subtype = attrib.get("subtype")
+                    orig = attrib.get("orig")
+                    norm = attrib.get("norm")
+
+                    pos = None
+                    if e.tag == PC_TAG:
+                        pos = "PUNCT"
+                    elif subtype == "number":
+                        pos = "NUM"
+
+                    if len(e) == 0:
+                        form = e.text or ""
+                    else:
+                        form = "".join(e.itertext(with_tail=False))
+                    text_parts.append(form)
+                    space_after = e.tail == " "
+                    if space_after:
+                        text_parts.append(" ")
+                    misc = []
+                    if type_ is not None:
+                        misc.append(f"Type={type_}")
+                    if subtype is not None:
+                        misc.append(f"Subtype={subtype}")
+                    if orig is not None:
+                        misc.append(f"Orig={orig}")
+                    if norm is not None:
+                        misc.append(f"Norm={norm}")
+                    forms.append(form)
+                    lemmas.append(attrib.get("lemma"))
+                    upos_tags.append(pos)
+                    space_afters.append(space_after)
+                    miscs.append(misc)
+                    logger.debug("Added %s as %d. token.", form, len(forms) - 1)
+                text = "".join(text_parts).strip()
+                nb_sentences += 1
+                lines = [
+                    f"# sent_id = {nb_sentences}",
+                    f"# text = {text}" if text else "# text",
+                ]
+                # the end of the sentence is no missing space
+                last = len(forms) - 1
+                for i, (form, lemma, upos, space_after, misc) in enumerate(
+                    zip(forms, lemmas, upos_tags, space_afters, miscs)
+                ):
+                    if not space_after and i != last:
+                        misc = ["SpaceAfter=No"] + misc
+                    lines.append(
+                        f"{i}\t{form}\t{lemma or '_'}\t{upos or '_'}"
+                        f"\t_\t_\t_\t_\t_\t{'|'.join(misc) or '_'}"
+                    )
+                sentence = "\n".join(lines) + "\n\n"
+                if validate and not is_valid(sentence):
+                    logger.error("Invalid CoNLL-U for sentence %d.", nb_sentences)
+                if nb_sentences > 1:
+                    f.write("\n")
+                f.write(sentence)
+                logger.debug("Added %s as %d. sentence.", text, nb_sentences)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    tmp_path.replace(out_path)
+    logger.info("Converted %d sentences.", nb_sentences)
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(
         prog="tei-to-conll-u-converter", formatter_class=ArgFormatter
@@ -75,13 +278,20 @@ if __name__ == "__main__":
         default="%(asctime)s [%(levelname)s] %(message)s",
         help="logging format.",
     )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="check every written sentence by parsing it with conllu.",
+    )
     parser.add_argument(
         "XML",
         nargs="+",
-        type=FileType("rb"),
         help="TEI-XML corpora file(s)",
     )
     args = parser.parse_args()
+    for path in args.XML:
+        if not Path(path).is_file():
+            parser.error(f"argument XML: can't open '{path}': not a file")
 
     if args.verbose == 0:
         level = logging.WARN
@@ -90,76 +300,12 @@ if __name__ == "__main__":
     else:
         level = logging.DEBUG
 
-    logging.basicConfig(
-        format=args.log_format,
-        level=level,
-        handlers=[logging.StreamHandler(sys.stdout)],
-    )
+    setup_logging(args.log_format, level)
 
-    for xml in args.XML:
-        logging.info(f"Start convertion of {xml.name}.")
-        sentences: List[TokenList] = []
-        parents = dict.fromkeys(
-            lxml.etree.parse(xml)
-            .getroot()
-            .findall(".//{http://www.tei-c.org/ns/1.0}w/..")
-        )
-        logging.info(f"Found {len(parents):d} sentences.")
-        for p in parents.keys():
-            logging.debug(f"Parsing words from {p.tag}.")
-            tokens = TokenList(metadata={"sent_id": len(sentences) + 1})
-            i = 0
-            for e in p.iter():
-                logging.debug(f"Found {e.tag} with {e.text}.")
-                if e.tag not in [
-                    "{http://www.tei-c.org/ns/1.0}w",
-                    "{http://www.tei-c.org/ns/1.0}pc",
-                ]:
-                    logging.debug(f"Skipping {e.tag}.")
-                    continue
-                pos = None
-                if e.tag == "{http://www.tei-c.org/ns/1.0}pc":
-                    pos = "PUNCT"
-                elif "subtype" in e.attrib and e.attrib["subtype"] == "number":
-                    pos = "NUM"
-
-                misc = []
-                if e.tail != " ":
-                    misc.append("SpaceAfter=No")
-                if "type" in e.attrib:
-                    misc.append(f"Type={e.attrib.get('type')}")
-                if "subtype" in e.attrib:
-                    misc.append(f"Subtype={e.attrib.get('subtype')}")
-                if "orig" in e.attrib:
-                    misc.append(f"Orig={e.attrib.get('orig')}")
-                if "norm" in e.attrib:
-                    misc.append(f"Norm={e.attrib.get('norm')}")
-                tokens.append(
-                    Token(
-                        {
-                            "id": i,
-                            "form": "".join(e.itertext(with_tail=False)),
-                            "lemma": e.attrib.get("lemma"),
-                            "upos": pos,
-                            "xpos": None,
-                            "feats": None,
-                            "head": None,
-                            "deprel": None,
-                            "deps": None,
-                            "misc": "|".join(misc) if len(misc) > 0 else None,
-                        }
-                    )
-                )
-                logging.debug(f"Added {tokens[-1]['form']} as {i:d}. token.")
-                i += 1
-            tokens[-1]["misc"] = None
-            text = ""
-            for t in tokens:
-                text += t["form"] + (" " if not t["misc"] == "SpaceAfter=No" else "")
-            tokens.metadata["text"] = text.strip()
-            sentences.append(tokens)
-            logging.debug(f"Added {text} as {len(sentences)}. sentence.")
-        logging.info(f"Converted {len(sentences):d} sentences.")
-        logging.info(f"Saving results to {xml.name.replace('.xml', '.conll')}.")
-        with open(xml.name.replace(".xml", ".conllu"), "w", encoding="utf8") as f:
-            f.write("\n".join([s.serialize() for s in sentences]))
+    if len(args.XML) == 1:
+        convert(args.XML[0], args.validate)
+    else:
+        with ProcessPoolExecutor(
+            initializer=setup_logging, initargs=(args.log_format, level)
+        ) as pool:
+            list(pool.map(partial(convert, validate=args.validate), args.XML))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# vim: ft=python fileencoding=utf-8 sts=4 sw=4 et:
+"""Tests for the TEI-XML to CoNLL-U converter."""
+
+import shutil
+import subprocess
+import sys
+import unittest
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+SCRIPT = Path(__file__).parent.parent / "convert.py"
+
+
+class ConvertTests(unittest.TestCase):
+    """Tests for convert.py."""
+
+    def setUp(self):
+        """Create a temporary working directory."""
+        self.tmp_dir = TemporaryDirectory()
+        self.tmp = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        """Remove the temporary working directory."""
+        self.tmp_dir.cleanup()
+
+    def run_convert(self, *args: str) -> subprocess.CompletedProcess:
+        """Run the converter with the given arguments."""
+        return subprocess.run(
+            [sys.executable, str(SCRIPT), *args],
+            capture_output=True,
+            encoding="utf8",
+        )
+
+    def test_nested_parents(self):
+        """Parents of <w> nested in other parents keep all their tokens."""
+        path = Path(shutil.copy(FIXTURES / "nested.xml", self.tmp))
+        self.assertEqual(self.run_convert(str(path)).returncode, 0)
+        self.assertEqual(
+            path.with_suffix(".conllu").read_text(encoding="utf8"),
+            (FIXTURES / "nested.conllu").read_text(encoding="utf8"),
+        )
+
+    def test_tokens_in_division_after_sentences(self):
+        """<w> in a division after converted sentences is rejected."""
+        path = self.tmp / "mixed.xml"
+        path.write_text(
+            '<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><div>'
+            "<p><s><w>a</w></s></p> <w>b</w></div></body></text></TEI>",
+            encoding="utf8",
+        )
+        result = self.run_convert(str(path))
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("is not supported", result.stderr)
+
+    def test_validate_newline_in_form(self):
+        """A line break in a form is reported instead of aborting."""
+        path = self.tmp / "newline.xml"
+        path.write_text(
+            '<TEI xmlns="http://www.tei-c.org/ns/1.0"><s><w>a\nb</w> <w>c</w></s>'
+            "</TEI>",
+            encoding="utf8",
+        )
+        result = self.run_convert("--validate", str(path))
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("Invalid CoNLL-U for sentence 1.", result.stdout)
+
+    def test_validate_empty_text(self):
+        """Sentences with empty text are valid."""
+        path = self.tmp / "empty.xml"
+        path.write_text(
+            '<TEI xmlns="http://www.tei-c.org/ns/1.0"><s><w/><w/></s></TEI>',
+            encoding="utf8",
+        )
+        result = self.run_convert("--validate", str(path))
+        self.assertEqual(result.returncode, 0)
+        self.assertNotIn("Invalid CoNLL-U", result.stdout)
+        self.assertIn(
+            "# text\n", path.with_suffix(".conllu").read_text(encoding="utf8")
+        )
+
+    def test_malformed_xml_keeps_output(self):
+        """An existing output is left untouched if the input is not well-formed."""
+        path = self.tmp / "malformed.xml"
+        path.write_text(
+            '<TEI xmlns="http://www.tei-c.org/ns/1.0"><s><w>a</w> <w>b</s></TEI>',
+            encoding="utf8",
+        )
+        out_path = path.with_suffix(".conllu")
+        out_path.write_text("previous\n", encoding="utf8")
+        result = self.run_convert(str(path))
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("XMLSyntaxError", result.stderr)
+        self.assertEqual(out_path.read_text(encoding="utf8"), "previous\n")
+        self.assertEqual(list(self.tmp.glob("*.part")), [])
+
+    def test_stdin_rejected(self):
+        """Reading from stdin is rejected with a usage error."""
+        result = self.run_convert("-")
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("can't open '-'", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()